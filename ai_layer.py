@@ -1,5 +1,17 @@
+import asyncio
+import hashlib
 import json
-from openai import OpenAI
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import httpx
+import orjson
+import streamlit as st
+from jsonschema import Draft202012Validator
+from openai import AsyncOpenAI, OpenAI
 
 
 AI_OUTPUT_SCHEMA = {
@@ -10,7 +22,6 @@ AI_OUTPUT_SCHEMA = {
         "summary": {"type": "string"},
         "top_issues": {
             "type": "array",
-            "minItems": 1,
             "items": {
                 "type": "object",
                 "additionalProperties": False,
@@ -26,90 +37,369 @@ AI_OUTPUT_SCHEMA = {
     }
 }
 
+# Check and compile the guardrail schema once at import, not on every AI run
+Draft202012Validator.check_schema(AI_OUTPUT_SCHEMA)
+AI_OUT_VALIDATOR = Draft202012Validator(AI_OUTPUT_SCHEMA)
+
+# Batched variant: one result per report, re-split by index on return
+AI_BATCH_OUTPUT_SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["results"],
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["index", "summary", "top_issues"],
+                "properties": {
+                    "index": {"type": "integer"},
+                    **AI_OUTPUT_SCHEMA["properties"],
+                }
+            }
+        }
+    }
+}
+
+Draft202012Validator.check_schema(AI_BATCH_OUTPUT_SCHEMA)
+AI_BATCH_OUT_VALIDATOR = Draft202012Validator(AI_BATCH_OUTPUT_SCHEMA)
+
+# Structured Outputs: the model is constrained server-side to AI_OUTPUT_SCHEMA,
+# so the prompt no longer needs to describe the output format
+AI_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "validation_report", "schema": AI_OUTPUT_SCHEMA, "strict": True},
+}
+AI_BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "validation_reports", "schema": AI_BATCH_OUTPUT_SCHEMA, "strict": True},
+}
+
+# Cache of AI responses for identical validation reports, so the iterate-fix-revalidate
+# loop does not pay for the same OpenAI call twice. Keyed on hashes only: the per-process
+# salt keeps the raw API key out of the cache key.
+_CACHE_TTL_SECONDS = 3600
+_CACHE_MAX_ENTRIES = 256
+_KEY_SALT = os.urandom(16)
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def _api_key_hash(api_key: str) -> str:
+    return hashlib.sha256(_KEY_SALT + api_key.encode()).hexdigest()
+
+
+# One client per browser session, kept across reruns so the pooled HTTP/2 connection to
+# api.openai.com stays warm. It lives in st.session_state, not in a process-wide cache,
+# so the BYOK key is dropped with the session; a new key replaces (and closes) the old client.
+def _get_client(api_key: str) -> OpenAI:
+    key_hash = _api_key_hash(api_key)
+    current = st.session_state.get("_openai_client")
+    if current is not None:
+        if current[0] == key_hash:
+            return current[1]
+        current[1].close()
+
+    client = OpenAI(
+        api_key=api_key,
+        http_client=httpx.Client(http2=True, limits=httpx.Limits(max_keepalive_connections=4)),
+    )
+    st.session_state["_openai_client"] = (key_hash, client)
+    return client
+
 
-def build_ai_prompt(report: dict) -> str:
+def _compact_json(value, sort_keys: bool = False) -> bytes:
+    try:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else 0, default=str)
+    except TypeError:
+        # orjson rejects integers wider than 64 bits, which the report keeps exact
+        return json.dumps(value, sort_keys=sort_keys, separators=(",", ":"), default=str).encode()
+
+
+def _issues_hash(issues: list) -> str:
+    return hashlib.sha256(_compact_json(issues, sort_keys=True)).hexdigest()
+
+
+def _cache_get(key: tuple):
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        stored_at, content = entry
+        if time.monotonic() - stored_at > _CACHE_TTL_SECONDS:
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return content
+
+
+def _cache_put(key: tuple, content: str) -> None:
+    with _response_cache_lock:
+        _response_cache[key] = (time.monotonic(), content)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > _CACHE_MAX_ENTRIES:
+            _response_cache.popitem(last=False)
+
+
+_REQUIRED_MESSAGE = re.compile(r"^(.+) is a required property$")
+
+
+def _prepare_issues(issues: list) -> list:
+    """
+    Select the issues sent to the model: identical failures are clustered and
+    only a subset is kept, to reduce token cost and avoid leaking too much data.
+    """
+    # Group identical failures (same rule at the same schema location) so repeated
+    # errors across array items are sent once, with a count and a few sample paths
+    groups = defaultdict(list)
+    for iss in issues:
+        groups[(iss["validator"], iss["schema_path"])].append(iss)
+
+    clusters = []
+    for g in groups.values():
+        cluster = {
+            "validator": g[0]["validator"],
+            "schema_path": g[0]["schema_path"],
+            "example_message": g[0]["message"],
+            "count": len(g),
+            "sample_paths": list(dict.fromkeys(i["path"] for i in g))[:5],
+            "expected": g[0]["expected"],
+            "invalid_value": g[0]["invalid_value"],
+        }
+        # `required` reports one error per missing property at the same schema location:
+        # the property names are the only part that differs, so collect them
+        if cluster["validator"] == "required":
+            matches = (_REQUIRED_MESSAGE.match(i["message"]) for i in g)
+            cluster["missing"] = list(dict.fromkeys(m.group(1) for m in matches if m))[:10]
+        clusters.append(cluster)
+
+    # Only send a subset to reduce cost (adjust as needed)
+    return clusters[:15]
+
+
+def _short(value) -> str:
+    # JSON-encoded so strings stay distinguishable from numbers (e.g. "12345" vs 12345)
+    text = _compact_json(value).decode()
+    return text[:120] + "..." if len(text) > 120 else text
+
+
+def _issues_block(trimmed: list) -> str:
+    # One line per issue: far fewer tokens than JSON objects repeating every key name
+    return "\n".join(
+        f"- {','.join(p or '(root)' for p in i['sample_paths'])} [{i['validator']}] x{i['count']} "
+        f"got={_short(i['invalid_value'])} expected={_short(i['expected'])} :: {i['example_message']}"
+        + (f" (missing: {', '.join(i['missing'])})" if i.get("missing") else "")
+        for i in trimmed
+    )
+
+
+def _token_budget(trimmed: list) -> int:
+    # Generation latency grows with output tokens: size the cap on the number of issues to explain
+    return min(800, 120 + 60 * len(trimmed))
+
+
+# Returned without calling OpenAI when a report has nothing to explain
+_NO_ISSUES_OUTPUT = {"summary": "No validation issues found.", "top_issues": []}
+
+_SYSTEM_PROMPT = "You explain JSON Schema validation issues and suggest fixes."
+
+_PROMPT_GUIDANCE = (
+    "You are an assistant helping a developer understand JSON Schema validation errors.\n"
+    "Given the validation issues, produce a concise explanation and practical fixes.\n\n"
+    "Rules:\n"
+    "- Do not invent fields that are not supported by the issues.\n"
+    "- Keep the summary short.\n"
+    "- Use targets like payload:/containers/0/weightKg.\n\n"
+    "Guidelines:\n"
+    "- Each issue line reads: <sample paths> [<rule>] x<count> got=<invalid value> expected=<constraint> :: <example message>.\n"
+    "- When available, explicitly include the invalid value and the expected constraint in the explanation.\n"
+    "- Each issue may represent multiple identical failures: mention the count in the explanation.\n"
+)
+
+
+def build_ai_prompt(report: dict) -> tuple:
     """
     Create a compact prompt using the deterministic validation report.
     Keep it small to reduce token cost and avoid leaking too much data.
+    Returns (prompt, max_tokens budget for the answer).
     """
-    issues = report.get("issues", [])
-    # Only send a subset to reduce cost (adjust as needed)
-    trimmed = issues[:15]
-
-    return (
-        "You are an assistant helping a developer understand JSON Schema validation errors.\n"
-        "Given the validation issues, produce a concise explanation and practical fixes.\n\n"
-        "IMPORTANT OUTPUT FORMAT (MUST FOLLOW EXACTLY):\n"
-        "Return ONLY valid JSON with these top-level keys:\n"
-        "- summary (string)\n"
-        "- top_issues (array)\n"
-        "Each item in top_issues MUST include exactly these keys:\n"
-        "- target (string, e.g. payload:/containers/0/weightKg)\n"
-        "- severity (low|medium|high)\n"
-        "- explanation (string)\n"
-        "- suggestion (string)\n\n"
-        "Do not output a separate suggested_fixes list.\n"
-        "Do not include any other keys.\n"
-        "Example output:\n"
-        "{\n"
-        '  "summary": "Multiple validation errors were detected in the payload.",\n'
-        '  "top_issues": [\n'
-        '    {\n'
-        '      "target": "payload:/containers/0/weightKg",\n'
-        '      "severity": "high",\n'
-        '      "explanation": "The field containers[0].weightKg must be >= 0 (minimum 0), but -5 was provided.",\n'
-        '      "suggestion": "Set weightKg to a non-negative value (e.g. 0 or greater)."\n'
-        '    },\n'
-        '    {\n'
-        '      "target": "payload:/bookingId",\n'
-        '      "severity": "medium",\n'
-        '      "explanation": "The field bookingId must be a string, but 12345 was provided as a number.",\n'
-        '      "suggestion": "Convert bookingId to a string value, e.g. \"12345\"."\n'
-        '    }\n'
-        '  ]\n'
-        "}\n\n"
-        "Rules:\n"
-        "- Output MUST be valid JSON.\n"
-        "- Do not invent fields that are not supported by the issues.\n"
-        "- Keep the summary short.\n\n"
-        "Guidelines:\n"
-        "- When available, explicitly include invalid_value and expected in the explanation.\n"
-        f"VALIDATION_ISSUES:\n{json.dumps(trimmed, indent=2)}\n"
+    trimmed = _prepare_issues(report.get("issues", []))
+    prompt = _PROMPT_GUIDANCE + f"VALIDATION_ISSUES:\n{_issues_block(trimmed)}\n"
+    return prompt, _token_budget(trimmed)
+
+
+def build_batched_ai_prompt(reports: list) -> tuple:
+    """
+    Create a single prompt covering several validation reports, indexed from 0.
+    Returns (prompt, max_tokens budget for the answer).
+    """
+    sections = []
+    budget = 0
+    for i, r in enumerate(reports):
+        trimmed = _prepare_issues(r.get("issues", []))
+        sections.append(f"--- REPORT {i} ---\n{_issues_block(trimmed)}")
+        budget += _token_budget(trimmed)
+    prompt = (
+        _PROMPT_GUIDANCE
+        + "- Return one result per report, with index set to the report number.\n"
+        + "VALIDATION_REPORTS:\n"
+        + "\n".join(sections)
+        + "\n"
     )
+    return prompt, budget
 
 
-def call_openai_for_explanation(api_key: str, report: dict, model: str = "gpt-4o-mini") -> dict:
+def call_openai_for_explanation(api_key: str, report: dict, model: str = "gpt-4o-mini"):
     """
-    BYOK call: uses user-provided API key. Returns a dict (parsed JSON).
+    BYOK call: uses user-provided API key. Streams the completion and returns a
+    (stream, finalize) pair:
+    - stream: generator yielding the raw JSON text as it arrives (for st.write_stream)
+    - finalize: once the stream is consumed, parses the accumulated text into a dict
+      and validates it against AI_OUTPUT_SCHEMA (raises on invalid output)
+    Identical reports are served from the response cache without calling OpenAI.
     """
-    client = OpenAI(api_key=api_key)
+    if not report.get("issues"):
+        content = orjson.dumps(_NO_ISSUES_OUTPUT).decode()
+        return iter([content]), lambda: dict(_NO_ISSUES_OUTPUT)
 
-    prompt = build_ai_prompt(report)
+    cache_key = (_api_key_hash(api_key), model, _issues_hash(report.get("issues", [])))
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return iter([cached]), lambda: orjson.loads(cached)
+
+    client = _get_client(api_key)
+
+    prompt, max_tokens = build_ai_prompt(report)
 
     resp = client.chat.completions.create(
         model=model,
         messages=[
-            {"role": "system", "content": "Return ONLY valid JSON matching the required keys. No extra keys. No markdown."},
+            {"role": "system", "content": _SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ],
+        response_format=AI_RESPONSE_FORMAT,
         temperature=0.2,
-        max_tokens=800,
+        max_tokens=max_tokens,
+        stream=True,
+    )
+
+    buf = []
+
+    def stream():
+        for chunk in resp:
+            if not chunk.choices:
+                continue
+            piece = chunk.choices[0].delta.content or ""
+            buf.append(piece)
+            yield piece
+
+    def finalize() -> dict:
+        content = "".join(buf)
+        data = orjson.loads(content)
+        # Guardrail: structured outputs constrain the model, but the output is still checked against
+        # AI_OUTPUT_SCHEMA here, before caching, so a rejected output is never replayed from the cache
+        AI_OUT_VALIDATOR.validate(data)
+        _cache_put(cache_key, content)
+        return data
+
+    return stream(), finalize
+
+
+# Output token limit of the offered models (gpt-4o, gpt-4o-mini). Each report may use up to
+# 800 output tokens, so batches are split to keep max_tokens under the limit
+_MAX_OUTPUT_TOKENS = 16384
+_BATCH_SIZE = _MAX_OUTPUT_TOKENS // 800
+
+
+def call_openai_batched(api_key: str, reports: list, model: str = "gpt-4o-mini") -> list:
+    """
+    BYOK call for several reports at once: a single completion shares the system
+    prompt and per-request overhead. Returns one dict per report, in input order.
+    Reports without issues get the no-issues output and are not sent.
+    """
+    results = [dict(_NO_ISSUES_OUTPUT) for _ in reports]
+    pending = [i for i, r in enumerate(reports) if r.get("issues")]
+    if not pending:
+        return results
+
+    client = _get_client(api_key)
+
+    for start in range(0, len(pending), _BATCH_SIZE):
+        indexes = pending[start:start + _BATCH_SIZE]
+        for i, result in zip(indexes, _call_batch(client, [reports[i] for i in indexes], model)):
+            results[i] = result
+    return results
+
+
+def _call_batch(client: OpenAI, reports: list, model: str) -> list:
+    prompt, max_tokens = build_batched_ai_prompt(reports)
+
+    resp = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": _SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ],
+        response_format=AI_BATCH_RESPONSE_FORMAT,
+        temperature=0.2,
+        max_tokens=max_tokens,
+    )
+
+    data = orjson.loads(resp.choices[0].message.content or "")
+    AI_BATCH_OUT_VALIDATOR.validate(data)
+
+    # Re-split by index
+    by_index = {
+        r["index"]: {"summary": r["summary"], "top_issues": r["top_issues"]}
+        for r in data["results"]
+    }
+    missing = [i for i in range(len(reports)) if i not in by_index]
+    if missing:
+        raise ValueError(f"AI output is missing results for report(s): {missing}")
+
+    return [by_index[i] for i in range(len(reports))]
+
+
+async def _acall(client: AsyncOpenAI, report: dict, model: str) -> dict:
+    if not report.get("issues"):
+        return dict(_NO_ISSUES_OUTPUT)
+
+    cache_key = (_api_key_hash(client.api_key), model, _issues_hash(report.get("issues", [])))
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return orjson.loads(cached)
+
+    prompt, max_tokens = build_ai_prompt(report)
+
+    resp = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": _SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ],
+        response_format=AI_RESPONSE_FORMAT,
+        temperature=0.2,
+        max_tokens=max_tokens,
     )
 
     content = resp.choices[0].message.content or ""
-    # Try to parse JSON output
-    data = json.loads(content)
-
-    # Fallback mapping for common alternative outputs
-    if "summary" not in data and "explanation" in data:
-        data = {
-            "summary": data.get("explanation", "")[:240],
-            "top_issues": [],
-            "suggested_fixes": [
-                {"target": f"payload:/{f.get('field','')}", "suggestion": f.get("action","")}
-                for f in data.get("fixes", [])
-            ],
-            "risk_notes": []
-        }
-    
+    data = orjson.loads(content)
+    # Same guardrail as the streaming path, before caching
+    AI_OUT_VALIDATOR.validate(data)
+    _cache_put(cache_key, content)
     return data
+
+
+async def _acall_many(api_key: str, reports: list, model: str) -> list:
+    # A single client for all requests: its httpx.AsyncClient pools the connections
+    async with AsyncOpenAI(api_key=api_key) as client:
+        return await asyncio.gather(*[_acall(client, r, model) for r in reports])
+
+
+def call_many(api_key: str, reports: list, model: str = "gpt-4o-mini") -> list:
+    """
+    BYOK call for several reports, one request per report issued concurrently.
+    Returns one dict per report, in input order.
+    """
+    return list(asyncio.run(_acall_many(api_key, reports, model)))
@@ -1,9 +1,15 @@
-# Imports: JSON parsing, Streamlit UI, and JSON Schema validator
+# Imports: JSON parsing (orjson, C-accelerated, with stdlib json as fallback), Streamlit UI,
+# and JSON Schema validator (Rust-backed)
 import json
+import re
+from operator import itemgetter
+from urllib.parse import unquote
+
+import jsonschema_rs
+import orjson
 import streamlit as st
-from jsonschema import Draft202012Validator
 # Imports: from internal source import the functions to call the OpenAI API and obtain human readable outputs
-from ai_layer import call_openai_for_explanation, AI_OUTPUT_SCHEMA
+from ai_layer import call_openai_for_explanation
 
 # Title and page icon setup
 st.set_page_config(page_title="Integration Contract Validator", page_icon="✅", layout="wide")
@@ -52,63 +58,201 @@ with col2:
     st.subheader("Output")
     result_box = st.empty()
 
+# orjson only handles 64-bit integers: wider ones are turned into floats on load and rejected on dump.
+# Inputs that may hold one (a number token of 19+ digits, i.e. not quoted inside a string) go through
+# stdlib json, which keeps them exact
+_WIDE_INT = re.compile(r"(?:^|[\[:,])\s*-?\d{19,}\s*(?:$|[\]},])")
+
+def _is_wide_int(value: int) -> bool:
+    return not -2**63 <= value < 2**64
+
+def _parse_json(text: str):
+    if _WIDE_INT.search(text):
+        return json.loads(text)
+    return orjson.loads(text)
+
+def _int_for_validation(text: str):
+    # jsonschema-rs rejects integers wider than 64 bits: it validates them as floats
+    value = int(text)
+    return float(value) if _is_wide_int(value) else value
+
+def _parse_payload(text: str) -> tuple:
+    # Returns (payload, copy to validate). The copy differs only when the payload really holds an
+    # integer wider than 64 bits: only then is the text parsed a second time
+    if not _WIDE_INT.search(text):
+        payload = orjson.loads(text)
+        return payload, payload
+
+    found_wide = False
+
+    def parse_int(token: str) -> int:
+        nonlocal found_wide
+        value = int(token)
+        found_wide = found_wide or _is_wide_int(value)
+        return value
+
+    payload = json.loads(text, parse_int=parse_int)
+    if not found_wide:
+        return payload, payload
+    return payload, json.loads(text, parse_int=_int_for_validation)
+
+def _dump_report(report: dict) -> bytes:
+    try:
+        return orjson.dumps(report, option=orjson.OPT_INDENT_2)
+    except TypeError:
+        return json.dumps(report, indent=2).encode()
+
+# Parsed inputs are cached on the text, so re-submitting unchanged inputs skips re-parsing
+@st.cache_data(show_spinner=False, max_entries=32)
 def _safe_json_load(text: str):
-    return json.loads(text)
+    return _parse_json(text)
 
-def _build_validator(schema: dict, strict: bool) -> Draft202012Validator:
+def _load_schema(schema_text: str, strict: bool) -> dict:
+    schema = _safe_json_load(schema_text)
     # If it's running in strict mode, ensure additionalProperties is false unless explicitly set
     if strict:
         schema = dict(schema)  # shallow copy
         schema_type = schema.get("type")
         if schema_type == "object":
             schema.setdefault("additionalProperties", False)
-    return Draft202012Validator(schema)
+    return schema
 
-def _format_issue(err) -> dict:
-    path = ".".join([str(p) for p in err.path]) if err.path else ""
-    schema_path = "/".join([str(p) for p in err.schema_path]) if err.schema_path else ""
+# Compiling the schema is the expensive step: compiled validators are reused across reruns
+# as long as the schema text and mode are unchanged
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _build_validator(schema_text: str, strict: bool) -> jsonschema_rs.Draft202012Validator:
+    return jsonschema_rs.Draft202012Validator(_load_schema(schema_text, strict))
+
+def _value_at(document, path) -> object:
+    # Walk a document along a path (e.g. an error's instance path) to find the value it points to
+    node = document
+    for part in path:
+        try:
+            node = node[part]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return node
+
+def _resolve_local_ref(schema: dict, ref: str) -> object:
+    # Follow a local "$ref" (a JSON pointer such as "#/$defs/item") inside the schema
+    ref = unquote(ref)
+    if not ref.startswith("#"):
+        return None
+    node = schema
+    for token in ref[1:].split("/")[1:]:
+        token = token.replace("~1", "/").replace("~0", "~")
+        node = _value_at(node, [int(token) if isinstance(node, list) and token.isdigit() else token])
+    return node
+
+def _schema_value(schema: dict, schema_path) -> object:
+    # Walk the schema along the error's schema path to find the failing keyword's value.
+    # Schema paths step through "$ref" into the referenced subschema, so local refs are followed
+    node = schema
+    for part in schema_path:
+        if part == "$ref" and isinstance(node, dict) and isinstance(node.get("$ref"), str):
+            node = _resolve_local_ref(schema, node["$ref"])
+        else:
+            node = _value_at(node, [part])
+        if node is None:
+            return None
+    return node
 
-    # Value found in the payload at the failing path (e.g. -5)
-    invalid_value = err.instance
+def _summarize_value(value, depth: int = 0):
+    # Bound the size of values copied into the report (and the AI prompt), whatever the payload size:
+    # long strings are cut, arrays keep first/last items, objects keep their top-level keys with types
+    if isinstance(value, str):
+        return value[:200] + "..." if len(value) > 200 else value
+    if isinstance(value, list):
+        if depth >= 2:
+            return f"<array of {len(value)} items>"
+        if len(value) <= 3:
+            return [_summarize_value(v, depth + 1) for v in value]
+        return [_summarize_value(value[0], depth + 1), f"...{len(value) - 2} more...", _summarize_value(value[-1], depth + 1)]
+    if isinstance(value, dict):
+        summary = {k: type(v).__name__ for k, v in list(value.items())[:10]}
+        if len(value) > 10:
+            summary["..."] = f"{len(value) - 10} more keys"
+        return summary
+    return value
 
-    # What the validator expected (e.g. minimum=0, type="string", enum=[...])
-    expected = err.validator_value
+def _shorten_message(message: str) -> str:
+    # jsonschema-rs messages embed the whole failing instance ("<instance> is not of type ..."):
+    # keep both ends so the constraint at the end of the message survives
+    return message[:100] + " ... " + message[-100:] if len(message) > 205 else message
+
+# Keywords whose values map names to subschemas: the segment after them is a name, not a keyword
+_SCHEMA_MAPS = {"properties", "patternProperties", "dependentSchemas", "$defs", "definitions"}
+
+def _failing_keyword(schema_path, node) -> str:
+    # The failing keyword is usually the last segment of the schema path (e.g. "minimum"). A `false`
+    # subschema fails on its own, so when the path ends at one under a property name, an array index
+    # or a "$ref", that segment is not a keyword and the rule is reported as "false"
+    if node is False and (
+        not schema_path
+        or isinstance(schema_path[-1], int)
+        or schema_path[-1] == "$ref"
+        or (len(schema_path) > 1 and schema_path[-2] in _SCHEMA_MAPS)
+    ):
+        return "false"
+    return str(schema_path[-1]) if schema_path else ""
+
+def _format_issue(err, path: tuple, schema: dict, payload) -> dict:
+    schema_path = err.schema_path
+
+    # Value found in the payload at the failing path (e.g. -5), read from the exact payload
+    invalid_value = _summarize_value(_value_at(payload, path))
+
+    # What the validator expected (e.g. minimum=0, type="string", enum=[...]). Its size depends on the
+    # schema, not the payload, so it is kept intact (enum/required lists included); only long strings are cut
+    expected = _schema_value(schema, schema_path)
+    if isinstance(expected, str):
+        expected = _summarize_value(expected)
 
     return {
-        "message": err.message,
-        "path": path,
-        "schema_path": schema_path,
-        "validator": err.validator,
+        "message": _shorten_message(err.message),
+        "path": ".".join(map(str, path)),
+        "schema_path": "/".join(map(str, schema_path)),
+        "validator": _failing_keyword(schema_path, expected),
         "expected": expected,
         "invalid_value": invalid_value,
     }
 
+# Validation reports are cached on the inputs: re-clicking Validate on unchanged inputs reuses the report
+@st.cache_data(show_spinner=False, max_entries=32)
+def _run_validation(schema_text: str, payload_text: str, strict: bool) -> dict:
+    validator = _build_validator(schema_text, strict)
+    # The payload is parsed here, once, and not through the cached loader: caching it would keep a
+    # pickled copy and rebuild the whole object on every hit, for inputs that can be tens of MB
+    payload, checked = _parse_payload(payload_text)
+
+    # Fast path: is_valid stops at the first mismatch and builds no error objects
+    if validator.is_valid(checked):
+        return {"pass": True, "issue_count": 0, "issues": []}
+
+    schema = _load_schema(schema_text, strict)
+    # Each error's path is materialized once, then shared by the sort and the formatting
+    errs = [(tuple(e.instance_path), e) for e in validator.iter_errors(checked)]
+    errs.sort(key=itemgetter(0))
+    formatted = [_format_issue(e, path, schema, payload) for path, e in errs]
+    return {
+        "pass": len(formatted) == 0,
+        "issue_count": len(formatted),
+        "issues": formatted,
+    }
+
 if validate:
     with col2:
-        report = {
-            "pass": False,
-            "issue_count": 0,
-            "issues": [],
-        }
-
         try:
-            schema = _safe_json_load(schema_text)
+            _safe_json_load(schema_text)
         except Exception as e:
             st.error(f"Schema is not valid JSON: {e}")
             st.stop()
 
         try:
-            payload = _safe_json_load(payload_text)
-        except Exception as e:
+            report = _run_validation(schema_text, payload_text, strict_mode)
+        except json.JSONDecodeError as e:
             st.error(f"Payload is not valid JSON: {e}")
             st.stop()
-
-        try:
-            validator = _build_validator(schema, strict_mode)
-            issues = sorted(validator.iter_errors(payload), key=lambda e: list(e.path))
-            report["issues"] = [_format_issue(i) for i in issues]
-            report["issue_count"] = len(report["issues"])
-            report["pass"] = report["issue_count"] == 0
         except Exception as e:
             st.error(f"Validation error: {e}")
             st.stop()
@@ -120,35 +264,46 @@ if validate:
 
         st.write("### Issues")
         if report["issues"]:
-            st.dataframe(report["issues"], use_container_width=True)
+            # expected/invalid_value mix types (and may hold integers wider than Arrow supports):
+            # the table shows them as JSON text, the exported report keeps the original values
+            rows = [
+                {**i, "expected": json.dumps(i["expected"]), "invalid_value": json.dumps(i["invalid_value"])}
+                for i in report["issues"]
+            ]
+            st.dataframe(rows, use_container_width=True)
         else:
             st.info("No issues found.")
 
         st.write("### Export")
         st.download_button(
             "Download report (JSON)",
-            data=json.dumps(report, indent=2),
+            data=_dump_report(report),
             file_name="validation_report.json",
             mime="application/json",
         )
 
         st.write("### AI explanation (just if AI mode is enabled)")
         if enable_ai:
-            if not api_key:
+            if not report["issues"]:
+                st.caption("No issues — AI explanation skipped.")
+            elif not api_key:
                 st.info("AI is enabled, but no API key was provided. Enter your own key to run AI assist.")
             else:
-                with st.spinner("Calling OpenAI..."):
-                    try:
-                        ai_out = call_openai_for_explanation(api_key=api_key, report=report, model=ai_model)
+                try:
+                    with st.spinner("Calling OpenAI..."):
+                        stream, finalize = call_openai_for_explanation(api_key=api_key, report=report, model=ai_model)
 
-                        # Validate AI output against our schema (guardrail)
-                        Draft202012Validator(AI_OUTPUT_SCHEMA).validate(ai_out)
+                    # Show the raw output live while it is generated, then replace it with the parsed JSON
+                    live = st.empty()
+                    live.write_stream(stream)
+                    # finalize() also validates the output against our schema (guardrail) and raises if it does not match
+                    ai_out = finalize()
 
-                        st.success("AI explanation generated.")
-                        st.json(ai_out)
+                    st.success("AI explanation generated.")
+                    live.json(ai_out)
 
-                    except Exception as e:
-                        st.error(f"AI assist failed: {e}")
+                except Exception as e:
+                    st.error(f"AI assist failed: {e}")
         else:
             st.caption("Enable AI assist to get explanations and fix suggestions (BYOK).")
 else: